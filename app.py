@@ -1,129 +1,195 @@
+import os
 import asyncio
-import json
+import hashlib
+import logging
 
 from clients import initialize_gemini, initialize_claude
 from pdf_handler import download_pdf_from_url
-from gemini_service import query_gemini_with_pdf
-from claude_ratio_service import query_claude_for_ratios
-from claude_service import query_claude
+from gemini_service import query_gemini_with_pdf, GEMINI_MODEL
+from claude_ratio_service import query_claude_for_ratios, RATIO_MODEL
+from claude_service import query_claude, ANALYSIS_MODEL
+from cache import ResponseCache, SingleFlight, make_cache_key
+from errors import is_error_output
 from logger import logger
 
+# Cap on Claude calls in flight across concurrent requests (Gemini's cap lives in gemini_service)
+_CLAUDE_SEMAPHORE = asyncio.Semaphore(int(os.environ.get("CLAUDE_CONCURRENCY", "4")))
+
+
+# Extraction results keyed on the PDF bytes, so re-analysing the same accounts skips Gemini
+_EXTRACTION_CACHE = ResponseCache(maxsize=128, ttl_seconds=86400)
+
+# Exact-match caches for repeated analyses of the same company, data and rent
+_RATIO_CACHE = ResponseCache(maxsize=256, ttl_seconds=1800)
+_ANALYSIS_CACHE = ResponseCache(maxsize=256, ttl_seconds=1800)
+
+# Identical requests arriving while a call is in flight share its result (keys are the cache keys)
+_IN_FLIGHT = SingleFlight()
+
+
+def _error_response(message: str, **fields) -> dict:
+    """Builds a fresh error response (callers such as main.py add keys to it)"""
+    return {"status": "error", "message": message, **fields}
+
+
+# Source attribution attached to error responses
+_SOURCE_NAME = "PDF Document"
+_SOURCE_CATEGORY = "Company data"
+
+
+def _build_sources(pdf_url: str) -> list:
+    """Returns the source attribution list for the analysed PDF"""
+    return [{"name": _SOURCE_NAME, "url": pdf_url, "category": _SOURCE_CATEGORY}]
+
+
+async def _bounded(semaphore: asyncio.Semaphore, func, *args):
+    """Awaits func(*args) while holding the given provider semaphore"""
+    async with semaphore:
+        return await func(*args)
+
+
+async def _extract_financial_data(gemini_client, pdf_content: bytes, company_name: str) -> str:
+    """Step 2: returns the extracted financial data from Gemini (or its error message)"""
+    # hashlib releases the GIL on large buffers, so hashing in a thread keeps the event loop free
+    pdf_sha256 = (await asyncio.to_thread(hashlib.sha256, pdf_content)).hexdigest()
+    # The extraction prompt does not use the company name, so the PDF content alone identifies the result
+    extraction_cache_key = make_cache_key(GEMINI_MODEL, pdf_sha256)
+    gemini_output = _EXTRACTION_CACHE.get(extraction_cache_key)
+    if gemini_output is not None:
+        logger.info("Step 2: Using cached financial data extraction")
+        return gemini_output
+
+    logger.info("Step 2: Extracting financial data with Gemini...")
+    gemini_output = await _IN_FLIGHT.run(
+        extraction_cache_key,
+        query_gemini_with_pdf, gemini_client, pdf_content, company_name, pdf_sha256
+    )
+
+    if not is_error_output(gemini_output):
+        _EXTRACTION_CACHE.set(extraction_cache_key, gemini_output)
+    return gemini_output
+
+
+async def _calculate_ratios(claude_client, gemini_output: str, company_name: str, annual_rent: str):
+    """Step 3: returns the ratio JSON text from Claude, or an error response dict"""
+    ratio_cache_key = make_cache_key(RATIO_MODEL, company_name, gemini_output, annual_rent)
+    claude_ratio_output = _RATIO_CACHE.get(ratio_cache_key)
+    if claude_ratio_output is not None:
+        logger.info("Step 3: Using cached financial ratios")
+        return claude_ratio_output
+
+    logger.info("Step 3: Calculating financial ratios with Claude...")
+    try:
+        claude_ratio_output = await _IN_FLIGHT.run(
+            ratio_cache_key, _bounded, _CLAUDE_SEMAPHORE,
+            query_claude_for_ratios, claude_client, gemini_output, company_name, annual_rent
+        )
+        
+        # Error handling for ratio calculation
+        if is_error_output(claude_ratio_output):
+            logger.error("Claude ratio calculation failed")
+            return _error_response("Financial ratio calculation failed", details=claude_ratio_output)
+
+        _RATIO_CACHE.set(ratio_cache_key, claude_ratio_output)
+        return claude_ratio_output
+            
+    except Exception as e_ratio:
+        logger.error(f"Claude ratio calculation error: {e_ratio}")
+        return _error_response(f"Ratio calculation error: {str(e_ratio)}")
+
+
+async def _generate_final_analysis(claude_client, company_name: str, claude_ratio_output: str, annual_rent: str) -> dict:
+    """Step 4: returns the parsed final analysis from Claude, or an error response dict"""
+    try:
+        analysis_cache_key = make_cache_key(ANALYSIS_MODEL, company_name, claude_ratio_output, annual_rent)
+        result = _ANALYSIS_CACHE.get(analysis_cache_key)
+        cache_hit = result is not None
+        if cache_hit:
+            logger.info("Step 4: Using cached final financial analysis")
+        else:
+            logger.info("Step 4: Generating final financial analysis...")
+            # query_claude parses and validates the JSON answer
+            result = await _IN_FLIGHT.run(
+                analysis_cache_key, _bounded, _CLAUDE_SEMAPHORE,
+                query_claude, claude_client, company_name, claude_ratio_output, annual_rent
+            )
+            
+            # Error handling for final analysis
+            if result.get("status") == "error":
+                logger.error("Claude final analysis failed")
+                return _error_response("Final financial analysis failed", details=result)
+
+            _ANALYSIS_CACHE.set(analysis_cache_key, result)
+
+        logger.info("Analysis completed successfully")
+        # Shallow copy so callers adding keys (processing_time) leave the cached entry intact
+        response = dict(result)
+        response["cache_hit"] = cache_hit
+        return response
+        
+    except Exception as e_analysis:
+        logger.error(f"Claude final analysis error: {e_analysis}")
+        return _error_response(f"Final analysis error: {str(e_analysis)}")
+
 
 async def run_analysis(company_name: str, pdf_url: str, annual_rent: str):
     """Runs the financial analysis pipeline for uploaded PDF accounts"""
-    logger.info(f"Starting analysis for {company_name}")
+    # Identical requests arriving together share one pipeline run, including the download.
+    # The run is its own task: a client disconnecting only stops that caller's wait, never the run
+    run_key = make_cache_key("run_analysis", company_name, pdf_url, annual_rent)
+    result = await _IN_FLIGHT.run(run_key, _run_analysis, company_name, pdf_url, annual_rent)
+    # Each caller gets its own dict, since main.py adds per-request keys (processing_time)
+    return dict(result)
 
-    gemini_client = initialize_gemini()
-    claude_client = initialize_claude()
 
-    if not gemini_client:
-        logger.error("Failed to initialize Gemini client")
-        return {"status": "error", "message": "Error: Failed to initialize AI clients.", "sources": []}
+async def _run_analysis(company_name: str, pdf_url: str, annual_rent: str) -> dict:
+    """Runs the pipeline steps; every failure is returned as an error response dict"""
+    logger.info(f"Starting analysis for {company_name}")
 
     try:
-        # STEP 1: Download PDF from URL
-        logger.info("Step 1: Downloading PDF...")
-        pdf_content = await download_pdf_from_url(pdf_url)
-        
+        # STEP 1: Download PDF from URL while the AI clients are initialized
+        logger.info("Step 1: Downloading PDF and initializing AI clients...")
+        # TaskGroup cancels the sibling tasks as soon as one of them fails
+        try:
+            async with asyncio.TaskGroup() as tg:
+                pdf_task = tg.create_task(download_pdf_from_url(pdf_url))
+                gemini_task = tg.create_task(asyncio.to_thread(initialize_gemini))
+                claude_task = tg.create_task(asyncio.to_thread(initialize_claude))
+        except ExceptionGroup as eg:
+            # Surface the first failure (e.g. the download error) rather than the group wrapper; the outer
+            # handler reports it once, and the group (with any other failures) stays attached as its cause
+            raise eg.exceptions[0] from eg
+        pdf_content, gemini_client, claude_client = pdf_task.result(), gemini_task.result(), claude_task.result()
+        # The finished tasks keep their results alive; drop them so only pdf_content holds the PDF bytes
+        del pdf_task, gemini_task, claude_task
+
+        if not gemini_client:
+            logger.error("Failed to initialize Gemini client")
+            return _error_response("Error: Failed to initialize AI clients.", sources=[])
+
         # STEP 2: Extract financial data with Gemini
-        logger.info("Step 2: Extracting financial data with Gemini...")
-        gemini_output = await query_gemini_with_pdf(gemini_client, pdf_content, company_name)
+        gemini_output = await _extract_financial_data(gemini_client, pdf_content, company_name)
+        # The PDF bytes are not needed by the Claude steps; release them before those long calls
+        del pdf_content
 
         # Error handling for Gemini
-        if gemini_output.startswith("Error"):
+        if is_error_output(gemini_output):
             logger.error("Gemini financial data extraction failed")
-            return {
-                "status": "error", 
-                "message": "Financial data extraction failed",
-                "details": gemini_output
-            }
+            return _error_response("Financial data extraction failed", details=gemini_output)
         
         # STEP 3: Calculate ratios with Claude Ratio Service
         if not claude_client:
             logger.error("Claude client not available for ratio calculation")
-            return {
-                "status": "error",
-                "message": "Claude client not available for financial analysis"
-            }
-        
-        logger.info("Step 3: Calculating financial ratios with Claude...")
-        try:
-            claude_ratio_output = query_claude_for_ratios(
-                claude_client, 
-                gemini_output, 
-                company_name, 
-                annual_rent
-            )
-            
-            # Error handling for ratio calculation
-            if claude_ratio_output.startswith("Error"):
-                logger.error("Claude ratio calculation failed")
-                return {
-                    "status": "error",
-                    "message": "Financial ratio calculation failed",
-                    "details": claude_ratio_output
-                }
-                
-        except Exception as e_ratio:
-            logger.error(f"Claude ratio calculation error: {e_ratio}")
-            return {
-                "status": "error",
-                "message": f"Ratio calculation error: {str(e_ratio)}"
-            }
-        
-        # STEP 4: Final financial analysis with Claude Analysis Service  
-        logger.info("Step 4: Generating final financial analysis...")
-        try:
-            final_analysis = query_claude(
-                company_name,
-                claude_ratio_output,
-                annual_rent
-            )
-            
-            # Error handling for final analysis
-            if final_analysis.startswith("Error") or '"status": "error"' in final_analysis:
-                logger.error("Claude final analysis failed")
-                return {
-                    "status": "error",
-                    "message": "Final financial analysis failed",
-                    "details": final_analysis
-                }
-            
-            # Clean JSON response - remove any markdown wrappers
-            cleaned_response = final_analysis.strip()
-            if cleaned_response.startswith("```json"):
-                cleaned_response = cleaned_response[7:]
-            if cleaned_response.startswith("```"):
-                cleaned_response = cleaned_response[3:]
-            if cleaned_response.endswith("```"):
-                cleaned_response = cleaned_response[:-3]
-            cleaned_response = cleaned_response.strip()
-
-            # Validate and parse JSON
-            try:
-                result = json.loads(cleaned_response)
-                logger.info("Analysis completed successfully")
-                return result
-            except json.JSONDecodeError as validate_err:
-                logger.error(f"Claude returned invalid JSON: {validate_err}")
-                logger.debug(f"Claude response sample: {cleaned_response[:500]}")
-                return {
-                    "status": "error",
-                    "message": f"Claude returned invalid JSON: {validate_err}"
-                }
-            
-        except Exception as e_analysis:
-            logger.error(f"Claude final analysis error: {e_analysis}")
-            return {
-                "status": "error",
-                "message": f"Final analysis error: {str(e_analysis)}"
-            }
+            return _error_response("Claude client not available for financial analysis")
+
+        claude_ratio_output = await _calculate_ratios(claude_client, gemini_output, company_name, annual_rent)
+        if isinstance(claude_ratio_output, dict):
+            return claude_ratio_output
+
+        # STEP 4: Final financial analysis, which depends on the ratio output
+        return await _generate_final_analysis(claude_client, company_name, claude_ratio_output, annual_rent)
 
     except Exception as e:
-        logger.error(f"Critical error in run_analysis: {str(e)}", exc_info=True)
-        error_response = {
-            "status": "error",
-            "message": f"Critical error during analysis: {str(e)}",
-            "sources": [{"name": "PDF Document", "url": pdf_url, "category": "Company data"}]
-        }
-        return error_response 
\ No newline at end of file
+        # Lazy formatting; the traceback is only rendered when debug logging is on
+        logger.error("Critical error in run_analysis: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
+        return _error_response(f"Critical error during analysis: {str(e)}", sources=_build_sources(pdf_url))
\ No newline at end of file
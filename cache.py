@@ -0,0 +1,82 @@
+import time
+import asyncio
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+def make_cache_key(*parts: str) -> str:
+    """Builds a stable SHA-256 cache key from the given string parts"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x1f")  # Separator so ("ab", "c") and ("a", "bc") differ
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    In-memory exact-match cache for LLM responses with TTL expiry and LRU eviction
+
+    Args:
+        maxsize: Maximum number of entries kept before evicting the least recently used
+        ttl_seconds: Lifetime of an entry in seconds
+    """
+
+    def __init__(self, maxsize: int = 256, ttl_seconds: float = 1800):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Returns the cached value for key, or None if absent or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        """Stores value under key, evicting the oldest entries past maxsize"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into a single in-flight call
+
+    The call runs as its own task; every caller, including the one that
+    started it, awaits that task through asyncio.shield, so cancelling any
+    caller never cancels the shared call or reaches the other callers.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def run(self, key: str, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        """Awaits func(*args), or the already in-flight call registered under key"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._finish, key))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        """Unregisters a finished call"""
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # Mark retrieved so a call whose callers all left does not log a warning
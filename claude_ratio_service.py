@@ -1,19 +1,14 @@
 import time
-import json
-from anthropic import Anthropic
+import orjson
+from anthropic import AsyncAnthropic
+from claude_service import JsonObjectScanner, log_prompt_cache_usage
+from errors import is_error_output
 from logger import logger
 
+RATIO_MODEL = "claude-sonnet-4-20250514"
 
-def query_claude_for_ratios(client: Anthropic, gemini_output: str, company_name: str, annual_rent: str) -> str:
-    """Query Claude 4 for financial ratio calculation from Gemini extracted data"""
-    try:
-        start_time = time.time()
-        
-        if not client:
-            logger.error("Claude client not initialized")
-            return "Error: Claude client not initialized"
-        
-        prompt = f"""CONTEXTE ET MISSION 
+# Static instructions sent as a cached system prompt (Anthropic prompt caching)
+RATIO_SYSTEM_PROMPT = """CONTEXTE ET MISSION 
 
 Vous êtes un analyste financier spécialisé dans le calcul de ratios comptables. Votre mission : Calculer tous les ratios financiers requis à partir des données financières fournies (sur les deux derniers exercices) et les retourner au format JSON structuré. 
 
@@ -21,11 +16,9 @@ IMPORTANT : Vous êtes uniquement responsable du calcul des ratios. Aucune analy
 
 INPUT ATTENDU 
 
-Nom de l'entreprise : {company_name} 
-
-Loyer payé par l'entreprise : {annual_rent} 
+Données financières : fournies à la suite de ces instructions (Bilan comptable actif/passif et compte de résultat détaillé sur les deux derniers exercices) 
 
-Données financières : {gemini_output} (Bilan comptable actif/passif et compte de résultat détaillé sur les deux derniers exercices) 
+Nom de l'entreprise et loyer payé par l'entreprise : fournis dans le message utilisateur 
 
 RATIOS À CALCULER 
 
@@ -274,9 +267,9 @@ Total dettes
 FORMAT DE SORTIE JSON REQUIS
 
 Votre JSON doit contenir deux sections :
-1. "ratios_calcules": {{{{ tous les ratios calculés organisés par catégories }}}}
-2. "donnees_brutes": {{{{ 
-   "annee_n": {{{{
+1. "ratios_calcules": {{ tous les ratios calculés organisés par catégories }}
+2. "donnees_brutes": {{ 
+   "annee_n": {{
      "chiffre_affaires": "valeur",
      "resultat_exploitation": "valeur", 
      "resultat_financier": "valeur",
@@ -284,8 +277,8 @@ Votre JSON doit contenir deux sections :
      "resultat_courant": "valeur",
      "capitaux_propres": "valeur",
      "total_dettes": "valeur"
-   }}}},
-   "annee_n_moins_1": {{{{
+   }},
+   "annee_n_moins_1": {{
      "chiffre_affaires": "valeur",
      "resultat_exploitation": "valeur",
      "resultat_financier": "valeur", 
@@ -293,51 +286,96 @@ Votre JSON doit contenir deux sections :
      "resultat_courant": "valeur",
      "capitaux_propres": "valeur",
      "total_dettes": "valeur"
-   }}}}
-}}}}
+   }}
+}}
 
 INSTRUCTIONS CRITIQUES POUR LE FORMAT DE SORTIE
 
 1. Votre réponse DOIT être un JSON valide UNIQUEMENT
 2. Aucun texte avant ou après le JSON
 3. Aucun markdown, aucune explication, SEULEMENT le JSON
-4. Commencez votre réponse directement par {{{{ et terminez par }}}}
+4. Commencez votre réponse directement par {{ et terminez par }}
 5. Incluez OBLIGATOIREMENT les deux sections : ratios_calcules ET donnees_brutes
 
 RÈGLE ABSOLUE : Retournez UNIQUEMENT le JSON complet avec ratios calculés ET données brutes extraites, rien d'autre"""
 
+
+async def query_claude_for_ratios(client: AsyncAnthropic, gemini_output: str, company_name: str, annual_rent: str) -> str:
+    """Query Claude 4 for financial ratio calculation from Gemini extracted data"""
+    try:
+        start_time = time.time()
+        
+        # Never bill a Claude call for a missing or failed extraction
+        if not gemini_output or is_error_output(gemini_output):
+            logger.error("Invalid Gemini output, skipping Claude ratio calculation")
+            return "Error: Invalid financial data for ratio calculation"
+        
+        if not client:
+            logger.error("Claude client not initialized")
+            return "Error: Claude client not initialized"
+        
+        # Only the dynamic inputs are built per call; the instructions are cached server-side
+        financial_data = f"Données financières : {gemini_output}"
+
+        user_content = f"""Nom de l'entreprise : {company_name} 
+
+Loyer payé par l'entreprise : {annual_rent} """
+
         logger.info("Starting Claude ratio calculation...")
         
-        response = client.messages.create(
-            model="claude-sonnet-4-20250514",
+        # Stream the answer and stop reading as soon as the JSON object is complete
+        chunks = []
+        scanner = JsonObjectScanner()
+        async with client.messages.stream(
+            model=RATIO_MODEL,
             max_tokens=8192,
             temperature=0.1,
+            system=[
+                {
+                    "type": "text",
+                    "text": RATIO_SYSTEM_PROMPT,
+                    "cache_control": {"type": "ephemeral"}
+                },
+                {
+                    "type": "text",
+                    "text": financial_data,
+                    "cache_control": {"type": "ephemeral"}
+                }
+            ],
             messages=[
                 {
                     "role": "user", 
-                    "content": prompt
+                    "content": user_content
                 }
             ]
-        )
+        ) as stream:
+            async for text in stream.text_stream:
+                end_idx = scanner.feed(text)
+                if end_idx != -1:
+                    chunks.append(text[:end_idx])
+                    logger.info("Claude ratio JSON complete, closing stream")
+                    break
+                chunks.append(text)
+            log_prompt_cache_usage(stream)
         
         total_time = time.time() - start_time
         logger.info(f"Claude ratio calculation completed in {total_time:.2f}s")
         
-        if not response or not response.content:
+        if not chunks:
             logger.error("Claude returned empty response")
             return "Error: Received an empty response from Claude."
         
-        response_text = response.content[0].text if response.content else ""
+        response_text = "".join(chunks)
         
         # Validate JSON structure
         try:
-            parsed_json = json.loads(response_text)
+            parsed_json = orjson.loads(response_text)
             logger.info("Claude returned valid JSON for ratio calculations")
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Claude returned invalid JSON: {e}")
             logger.error(f"Response text length: {len(response_text)}")
             logger.error(f"Response text (first 200 chars): '{response_text[:200]}'")
-            logger.debug(f"Raw Claude response (first 1000 chars): {response_text[:1000]}")
+            logger.debug("Raw Claude response (first 1000 chars): %.1000s", response_text)
             
             # Try to extract JSON from the response if it's wrapped in text
             text = response_text.strip()
@@ -353,10 +391,10 @@ RÈGLE ABSOLUE : Retournez UNIQUEMENT le JSON complet avec ratios calculés ET d
             if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
                 try:
                     json_part = text[start_idx:end_idx + 1]
-                    parsed_json = json.loads(json_part)
+                    parsed_json = orjson.loads(json_part)
                     logger.info("Successfully extracted JSON from Claude response")
-                    return json.dumps(parsed_json, ensure_ascii=False)
-                except json.JSONDecodeError as extract_error:
+                    return orjson.dumps(parsed_json).decode()
+                except orjson.JSONDecodeError as extract_error:
                     logger.error(f"Could not extract valid JSON from Claude response: {extract_error}")
                     logger.error(f"Attempted to parse: '{json_part[:200]}'")
             else:
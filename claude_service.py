@@ -1,20 +1,13 @@
 import time
-import json
-from clients import initialize_claude
+import orjson
+from anthropic import AsyncAnthropic
+from errors import is_error_output
 from logger import logger
 
+ANALYSIS_MODEL = "claude-sonnet-4-20250514"
 
-def query_claude(company_name: str, claude_ratio_output: str, annual_rent: str, conversation_context=None) -> str:
-    """Call Claude API with Claude ratio output for final financial analysis"""
-    start_time = time.time()
-    
-    client = initialize_claude()
-    if not client:
-        return json.dumps({"status": "error", "message": "Error initializing Claude client"}, indent=2)
-
-    try:
-        # Create prompt for Claude
-        prompt = f"""CONTEXTE ET MISSION
+# Static instructions sent as a cached system prompt (Anthropic prompt caching)
+ANALYSIS_SYSTEM_PROMPT = """CONTEXTE ET MISSION
 
 Vous êtes un analyste financier senior spécialisé dans l'évaluation de solvabilité locative. Votre mission : Analyser la solidité financière d'une entreprise candidate à la location d'un local commercial à partir des ratios financiers et données brutes calculés par l'Agent 1.
 
@@ -26,10 +19,12 @@ Objectif final : Déterminer la fiabilité de l'entreprise en tant que futur loc
 
 INPUT ATTENDU
 
-{{  "claude_ratio service output": {claude_ratio_output}, 
-  "company_name": "{company_name}", 
-  "loyer": "{annual_rent}" 
-}}
+Le message utilisateur contient le JSON suivant :
+
+{  "claude_ratio service output": { ratios calculés et données brutes }, 
+  "company_name": "Nom de l'entreprise", 
+  "loyer": "Montant du loyer" 
+}
 
 INSTRUCTIONS CRITIQUES POUR LE FORMAT DE SORTIE
 
@@ -42,7 +37,7 @@ FORMAT DE SORTIE OBLIGATOIRE
 
 Votre réponse doit être un JSON unique contenant ces trois sections :
 
-{{ "companyName": "Nom de l'entreprise", "annualRent": "Chiffre d'affaires annuel en K€", "annee_n": "année", "annee_n_moins_1": "année", "ratios": {{ "structure_financiere": {{ "annee_n": {{ "ressources_propres": "valeur", "ressources_stables": "valeur", "capital_exploitation": "valeur", "actif_circulant_exploitation": "valeur", "actif_circulant_hors_exploitation": "valeur", "dettes_exploitation": "valeur", "dettes_hors_exploitation": "valeur", "surface_financiere_pct": "valeur", "couverture_immobilisations_fonds_propres_pct": "valeur", "couverture_emplois_stables_pct": "valeur", "frng": "valeur", "bfr": "valeur", "tresorerie_nette": "valeur", "independance_financiere_pct": "valeur", "liquidite_entreprise_pct": "valeur" }}, "annee_n_moins_1": {{ "ressources_propres": "valeur", "ressources_stables": "valeur", "capital_exploitation": "valeur", "actif_circulant_exploitation": "valeur", "actif_circulant_hors_exploitation": "valeur", "dettes_exploitation": "valeur", "dettes_hors_exploitation": "valeur", "surface_financiere_pct": "valeur", "couverture_immobilisations_fonds_propres_pct": "valeur", "couverture_emplois_stables_pct": "valeur", "frng": "valeur", "bfr": "valeur", "tresorerie_nette": "valeur", "independance_financiere_pct": "valeur", "liquidite_entreprise_pct": "valeur" }} }}, "activite_exploitation": {{ "annee_n": {{ "marge_globale": "valeur", "valeur_ajoutee": "valeur", "ebe": "valeur", "caf": "valeur", "charges_personnel_valeur_ajoutee_pct": "valeur", "impots_valeur_ajoutee_pct": "valeur", "charges_financieres_valeur_ajoutee_pct": "valeur", "taux_marge_globale_pct": "valeur", "taux_valeur_ajoutee_pct": "valeur", "taux_marge_beneficiaire_pct": "valeur", "taux_marge_brute_exploitation_pct": "valeur", "taux_obsolescence_pct": "valeur" }}, "annee_n_moins_1": {{ "marge_globale": "valeur", "valeur_ajoutee": "valeur", "ebe": "valeur", "caf": "valeur", "charges_personnel_valeur_ajoutee_pct": "valeur", "impots_valeur_ajoutee_pct": "valeur", "charges_financieres_valeur_ajoutee_pct": "valeur", "taux_marge_globale_pct": "valeur", "taux_valeur_ajoutee_pct": "valeur", "taux_marge_beneficiaire_pct": "valeur", "taux_marge_brute_exploitation_pct": "valeur", "taux_obsolescence_pct": "valeur" }} }}, "rentabilite": {{ "annee_n": {{ "rentabilite_capitaux_propres_pct": "valeur", "rentabilite_economique_pct": "valeur", "rentabilite_financiere_pct": "valeur", "rentabilite_brute_ressources_stables_pct": "valeur", "rentabilite_brute_capital_exploitation_pct": "valeur" }}, "annee_n_moins_1": {{ "rentabilite_capitaux_propres_pct": "valeur", "rentabilite_economique_pct": "valeur", "rentabilite_financiere_pct": "valeur", "rentabilite_brute_ressources_stables_pct": "valeur", "rentabilite_brute_capital_exploitation_pct": "valeur" }} }}, "evolution": {{ "taux_variation_chiffre_affaires_pct": "valeur", "taux_variation_valeur_ajoutee_pct": "valeur", "taux_variation_resultat_pct": "valeur", "taux_variation_capitaux_propres_pct": "valeur" }}, "tresorerie_financement": {{ "annee_n": {{ "capacite_generer_cash": "valeur", "capacite_remboursement_dette": "valeur", "credits_bancaires_bfr": "valeur" }}, "annee_n_moins_1": {{ "capacite_generer_cash": "valeur", "capacite_remboursement_dette": "valeur", "credits_bancaires_bfr": "valeur" }} }}, "delais_paiement": {{ "annee_n": {{ "delai_creance_clients_jours": "valeur", "delai_dettes_fournisseurs_jours": "valeur" }}, "annee_n_moins_1": {{ "delai_creance_clients_jours": "valeur", "delai_dettes_fournisseurs_jours": "valeur" }} }} }}, "chiffres_cles": {{ "chiffre_affaires_n": "valeur en K€", "chiffre_affaires_n_moins_1": "valeur en K€", "marge_globale_n": "valeur en K€", "marge_globale_n_moins_1": "valeur en K€", "taux_marge_globale_n": "valeur en %", "taux_marge_globale_n_moins_1": "valeur en %", "valeur_ajoutee_n": "valeur en K€", "valeur_ajoutee_n_moins_1": "valeur en K€", "taux_valeur_ajoutee_n": "valeur en %", "taux_valeur_ajoutee_n_moins_1": "valeur en %", "ebe_n": "valeur en K€", "ebe_n_moins_1": "valeur en K€", "resultat_exploitation_n": "valeur en K€", "resultat_exploitation_n_moins_1": "valeur en K€", "resultat_financier_n": "valeur en K€", "resultat_financier_n_moins_1": "valeur en K€", "resultat_courant_n": "valeur en K€", "resultat_courant_n_moins_1": "valeur en K€", "resultat_exercice_n": "valeur en K€", "resultat_exercice_n_moins_1": "valeur en K€", "marge_exploitation_n": "valeur en %", "marge_exploitation_n_moins_1": "valeur en %", "resultat_net_n": "valeur en K€", "resultat_net_n_moins_1": "valeur en K€", "capitaux_propres_n": "valeur en K€", "capitaux_propres_n_moins_1": "valeur en K€", "dette_financiere_n": "valeur en K€", "dette_financiere_n_moins_1": "valeur en K€" }}, "analyse_financiere": "Texte de l'analyse complète de 800 mots" }}
+{ "companyName": "Nom de l'entreprise", "annualRent": "Chiffre d'affaires annuel en K€", "annee_n": "année", "annee_n_moins_1": "année", "ratios": { "structure_financiere": { "annee_n": { "ressources_propres": "valeur", "ressources_stables": "valeur", "capital_exploitation": "valeur", "actif_circulant_exploitation": "valeur", "actif_circulant_hors_exploitation": "valeur", "dettes_exploitation": "valeur", "dettes_hors_exploitation": "valeur", "surface_financiere_pct": "valeur", "couverture_immobilisations_fonds_propres_pct": "valeur", "couverture_emplois_stables_pct": "valeur", "frng": "valeur", "bfr": "valeur", "tresorerie_nette": "valeur", "independance_financiere_pct": "valeur", "liquidite_entreprise_pct": "valeur" }, "annee_n_moins_1": { "ressources_propres": "valeur", "ressources_stables": "valeur", "capital_exploitation": "valeur", "actif_circulant_exploitation": "valeur", "actif_circulant_hors_exploitation": "valeur", "dettes_exploitation": "valeur", "dettes_hors_exploitation": "valeur", "surface_financiere_pct": "valeur", "couverture_immobilisations_fonds_propres_pct": "valeur", "couverture_emplois_stables_pct": "valeur", "frng": "valeur", "bfr": "valeur", "tresorerie_nette": "valeur", "independance_financiere_pct": "valeur", "liquidite_entreprise_pct": "valeur" } }, "activite_exploitation": { "annee_n": { "marge_globale": "valeur", "valeur_ajoutee": "valeur", "ebe": "valeur", "caf": "valeur", "charges_personnel_valeur_ajoutee_pct": "valeur", "impots_valeur_ajoutee_pct": "valeur", "charges_financieres_valeur_ajoutee_pct": "valeur", "taux_marge_globale_pct": "valeur", "taux_valeur_ajoutee_pct": "valeur", "taux_marge_beneficiaire_pct": "valeur", "taux_marge_brute_exploitation_pct": "valeur", "taux_obsolescence_pct": "valeur" }, "annee_n_moins_1": { "marge_globale": "valeur", "valeur_ajoutee": "valeur", "ebe": "valeur", "caf": "valeur", "charges_personnel_valeur_ajoutee_pct": "valeur", "impots_valeur_ajoutee_pct": "valeur", "charges_financieres_valeur_ajoutee_pct": "valeur", "taux_marge_globale_pct": "valeur", "taux_valeur_ajoutee_pct": "valeur", "taux_marge_beneficiaire_pct": "valeur", "taux_marge_brute_exploitation_pct": "valeur", "taux_obsolescence_pct": "valeur" } }, "rentabilite": { "annee_n": { "rentabilite_capitaux_propres_pct": "valeur", "rentabilite_economique_pct": "valeur", "rentabilite_financiere_pct": "valeur", "rentabilite_brute_ressources_stables_pct": "valeur", "rentabilite_brute_capital_exploitation_pct": "valeur" }, "annee_n_moins_1": { "rentabilite_capitaux_propres_pct": "valeur", "rentabilite_economique_pct": "valeur", "rentabilite_financiere_pct": "valeur", "rentabilite_brute_ressources_stables_pct": "valeur", "rentabilite_brute_capital_exploitation_pct": "valeur" } }, "evolution": { "taux_variation_chiffre_affaires_pct": "valeur", "taux_variation_valeur_ajoutee_pct": "valeur", "taux_variation_resultat_pct": "valeur", "taux_variation_capitaux_propres_pct": "valeur" }, "tresorerie_financement": { "annee_n": { "capacite_generer_cash": "valeur", "capacite_remboursement_dette": "valeur", "credits_bancaires_bfr": "valeur" }, "annee_n_moins_1": { "capacite_generer_cash": "valeur", "capacite_remboursement_dette": "valeur", "credits_bancaires_bfr": "valeur" } }, "delais_paiement": { "annee_n": { "delai_creance_clients_jours": "valeur", "delai_dettes_fournisseurs_jours": "valeur" }, "annee_n_moins_1": { "delai_creance_clients_jours": "valeur", "delai_dettes_fournisseurs_jours": "valeur" } } }, "chiffres_cles": { "chiffre_affaires_n": "valeur en K€", "chiffre_affaires_n_moins_1": "valeur en K€", "marge_globale_n": "valeur en K€", "marge_globale_n_moins_1": "valeur en K€", "taux_marge_globale_n": "valeur en %", "taux_marge_globale_n_moins_1": "valeur en %", "valeur_ajoutee_n": "valeur en K€", "valeur_ajoutee_n_moins_1": "valeur en K€", "taux_valeur_ajoutee_n": "valeur en %", "taux_valeur_ajoutee_n_moins_1": "valeur en %", "ebe_n": "valeur en K€", "ebe_n_moins_1": "valeur en K€", "resultat_exploitation_n": "valeur en K€", "resultat_exploitation_n_moins_1": "valeur en K€", "resultat_financier_n": "valeur en K€", "resultat_financier_n_moins_1": "valeur en K€", "resultat_courant_n": "valeur en K€", "resultat_courant_n_moins_1": "valeur en K€", "resultat_exercice_n": "valeur en K€", "resultat_exercice_n_moins_1": "valeur en K€", "marge_exploitation_n": "valeur en %", "marge_exploitation_n_moins_1": "valeur en %", "resultat_net_n": "valeur en K€", "resultat_net_n_moins_1": "valeur en K€", "capitaux_propres_n": "valeur en K€", "capitaux_propres_n_moins_1": "valeur en K€", "dette_financiere_n": "valeur en K€", "dette_financiere_n_moins_1": "valeur en K€" }, "analyse_financiere": "Texte de l'analyse complète de 800 mots" }
 
 ANALYSE FINANCIÈRE À PRODUIRE
 
@@ -210,45 +205,133 @@ Format de l'analyse : Texte de 800 mots avec phrases courtes, données chiffrée
 
 Conclusion : Recommandation claire avec niveau de risque explicite
 
-IMPORTANT : Commencez votre réponse directement par {{ et terminez par }}. Aucun texte explicatif.
+IMPORTANT : Commencez votre réponse directement par { et terminez par }. Aucun texte explicatif.
 
 EXEMPLE DE STRUCTURE JSON ATTENDUE (simplifié):
-{{
+{
   "companyName": "...",
   "annualRent": "...", 
-  "ratios": {{ ... }},
-  "chiffres_cles": {{ ... }},
+  "ratios": { ... },
+  "chiffres_cles": { ... },
   "analyse_financiere": "Votre analyse de 800 mots ici..."
-}}
+}
 
 ATTENTION: Le champ "analyse_financiere" doit être le DERNIER champ et contenir tout le texte d'analyse en une seule chaîne de caractères."""
 
+
+class JsonObjectScanner:
+    """Tracks brace depth over streamed text to find where the first top-level JSON object ends"""
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> int:
+        """Returns the index just past the closing brace within text, or -1 if still open"""
+        for index, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == "{":
+                self.depth += 1
+                self.started = True
+            elif not self.started:
+                continue
+            elif char == '"':
+                self.in_string = True
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    return index + 1
+        return -1
+
+
+def log_prompt_cache_usage(stream) -> None:
+    """Logs prompt-cache reads/writes from a message stream; purely informational, never raises"""
+    try:
+        # Input usage (including prompt-cache hits) arrives with the first stream event
+        usage = stream.current_message_snapshot.usage
+    except Exception:
+        return
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_written = getattr(usage, "cache_creation_input_tokens", None) or 0
+    logger.info("Claude prompt cache: %d tokens read, %d tokens written", cache_read, cache_written)
+
+
+async def query_claude(client: AsyncAnthropic, company_name: str, claude_ratio_output: str, annual_rent: str, conversation_context=None) -> dict:
+    """Call Claude API with Claude ratio output for final financial analysis
+
+    Returns the parsed analysis, or a dict with "status": "error" on failure.
+    """
+    start_time = time.time()
+    
+    # Never bill a Claude call for a missing or failed ratio step
+    if not claude_ratio_output or is_error_output(claude_ratio_output):
+        logger.error("Invalid ratio output, skipping Claude final analysis")
+        return {"status": "error", "message": "Invalid ratio output for final analysis"}
+    
+    if not client:
+        logger.error("Claude client not initialized")
+        return {"status": "error", "message": "Error initializing Claude client"}
+
+    try:
+        # Only the input JSON is built per call; the instructions are cached server-side
+        user_content = f"""{{  "claude_ratio service output": {claude_ratio_output}, 
+  "company_name": "{company_name}", 
+  "loyer": "{annual_rent}" 
+}}"""
+
         logger.info(f"Calling Claude for final financial analysis for {company_name}")
 
         logger.info(f"Making Claude API call for final analysis")
 
-        response = client.messages.create(
-            model="claude-sonnet-4-20250514",
+        # Stream the answer and stop reading as soon as the JSON object is complete
+        chunks = []
+        scanner = JsonObjectScanner()
+        async with client.messages.stream(
+            model=ANALYSIS_MODEL,
             max_tokens=8192,
             temperature=0.2,
+            system=[{
+                "type": "text",
+                "text": ANALYSIS_SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"}
+            }],
             messages=[{
                 "role": "user",
-                "content": prompt
+                "content": user_content
             }]
-        )
-
-        if not response or not response.content:
+        ) as stream:
+            async for text in stream.text_stream:
+                end_idx = scanner.feed(text)
+                if end_idx != -1:
+                    chunks.append(text[:end_idx])
+                    logger.info("Claude JSON object complete, closing stream")
+                    break
+                chunks.append(text)
+            log_prompt_cache_usage(stream)
+
+        if not chunks:
             logger.error("Claude returned empty response")
-            return json.dumps({"status": "error", "message": "Empty response from Claude"}, indent=2)
+            return {"status": "error", "message": "Empty response from Claude"}
         
-        response_text = response.content[0].text
+        response_text = "".join(chunks)
         
         total_time = time.time() - start_time
         logger.info(f"Claude analysis completed in {total_time:.2f}s")
         
         # Try to parse and validate the JSON response
         try:
-            parsed_response = json.loads(response_text)
+            parsed_response = orjson.loads(response_text)
+            if not isinstance(parsed_response, dict):
+                logger.error("Claude response is valid JSON but not an object as expected")
+                return {"status": "error", "message": "Claude returned a non-object JSON value"}
             
             # Validate that required fields are present
             required_fields = ["companyName", "ratios", "chiffres_cles", "analyse_financiere"]
@@ -256,37 +339,37 @@ ATTENTION: Le champ "analyse_financiere" doit être le DERNIER champ et contenir
             
             if missing_fields:
                 logger.error(f"Claude response missing required fields: {missing_fields}")
-                logger.debug(f"Available fields: {list(parsed_response.keys())}")
-                logger.debug(f"Raw response (first 1000 chars): {response_text[:1000]}")
+                logger.debug("Available fields: %s", list(parsed_response))
+                logger.debug("Raw response (first 1000 chars): %.1000s", response_text)
                 
                 # Try to fix common issues
                 if "analyse_financiere" not in parsed_response and "analyse_financiere" in response_text:
                     logger.info("Attempting to fix malformed JSON by extracting analyse_financiere")
                     # This is a fallback - the JSON structure is broken
-                    return json.dumps({
+                    return {
                         "status": "error", 
                         "message": "Claude returned incomplete JSON structure",
                         "debug_info": f"Missing fields: {missing_fields}"
-                    }, indent=2)
+                    }
             
             logger.info("Claude returned valid JSON for financial analysis")
-            return json.dumps(parsed_response, ensure_ascii=False, indent=2)
+            return parsed_response
             
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Claude returned invalid JSON: {e}")
             logger.error(f"Response text length: {len(response_text)}")
             logger.error(f"Response text (first 200 chars): '{response_text[:200]}'")
-            logger.debug(f"Raw response (first 1000 chars): {response_text[:1000]}")
+            logger.debug("Raw response (first 1000 chars): %.1000s", response_text)
             
             # Try to extract JSON from the response if it's wrapped in text
             text = response_text.strip()
             
             if not text:
                 logger.error("Claude returned completely empty response")
-                return json.dumps({
+                return {
                     "status": "error", 
                     "message": "Claude returned empty response for final analysis"
-                }, indent=2)
+                }
             
             # Look for JSON object patterns  
             start_idx = text.find('{')
@@ -295,27 +378,27 @@ ATTENTION: Le champ "analyse_financiere" doit être le DERNIER champ et contenir
             if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
                 try:
                     json_part = text[start_idx:end_idx + 1]
-                    parsed_json = json.loads(json_part)
+                    parsed_json = orjson.loads(json_part)
                     logger.info("Successfully extracted JSON from Claude response")
-                    return json.dumps(parsed_json, ensure_ascii=False, indent=2)
-                except json.JSONDecodeError as extract_error:
+                    return parsed_json
+                except orjson.JSONDecodeError as extract_error:
                     logger.error(f"Could not extract valid JSON from Claude response: {extract_error}")
                     logger.error(f"Attempted to parse: '{json_part[:200]}'")
             else:
                 logger.error("No JSON object pattern found in Claude response")
             
             # If JSON extraction fails, return the error in a structured format
-            return json.dumps({
+            return {
                 "status": "error", 
                 "message": f"Claude returned malformed JSON: {str(e)}",
                 "raw_response": response_text[:500]
-            }, indent=2)
+            }
         
     except Exception as e:
         logger.error(f"Claude analysis failed: {str(e)}", exc_info=True)
         total_time = time.time() - start_time
-        return json.dumps({
+        return {
             "status": "error",
             "message": f"Error during Claude analysis: {str(e)}",
             "processing_time": total_time
-        }, indent=2) 
+        } 
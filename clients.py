@@ -1,7 +1,11 @@
 import os
+import asyncio
+import threading
 from typing import Optional
 from google import genai
+from google.genai import types
 import anthropic
+import httpx
 from logger import logger
 
 # Load credentials from environment variables
@@ -14,34 +18,82 @@ except Exception as e:
     GEMINI_API_KEY = ""
     CLAUDE_API_KEY = ""
 
+# Process-wide clients, kept only once built successfully so a failed init is retried on the next call
+_GEMINI_CLIENT: Optional[genai.Client] = None
+_CLAUDE_CLIENT: Optional[anthropic.AsyncAnthropic] = None
+_CLIENT_LOCK = threading.Lock()
+
 
 def initialize_gemini() -> Optional[genai.Client]:
-    """Initializes and returns a Gemini API client instance."""
+    """Initializes and returns the process-wide Gemini API client instance."""
+    global _GEMINI_CLIENT
+    if _GEMINI_CLIENT is not None:
+        return _GEMINI_CLIENT
+
     if not GEMINI_API_KEY:
         logger.error("Gemini API key not found in environment variables")
         return None
     
     try:
-        # Initialize the Gemini Client
-        client = genai.Client(api_key=GEMINI_API_KEY)
-        logger.info("Successfully initialized Gemini Client")
-        return client
+        with _CLIENT_LOCK:
+            if _GEMINI_CLIENT is None:
+                # Bound each Gemini request (milliseconds) so a stuck call fails instead of hanging the request
+                _GEMINI_CLIENT = genai.Client(api_key=GEMINI_API_KEY, http_options=types.HttpOptions(timeout=180_000))
+                logger.info("Successfully initialized Gemini Client")
+        return _GEMINI_CLIENT
     except Exception as e:
         logger.error(f"Error initializing Gemini Client: {str(e)}")
         return None
 
 
 def initialize_claude():
-    """Initialize Claude client"""
+    """Initialize the process-wide async Claude client (shared across requests)"""
+    global _CLAUDE_CLIENT
+    if _CLAUDE_CLIENT is not None:
+        return _CLAUDE_CLIENT
+
     if not CLAUDE_API_KEY:
         logger.error("Claude API key not found in environment variables")
         return None
     
     try:
-        # Initialize the Claude client with only required parameters
-        client = anthropic.Anthropic(api_key=CLAUDE_API_KEY)
-        logger.info("Successfully initialized Claude Client")
-        return client
+        with _CLIENT_LOCK:
+            if _CLAUDE_CLIENT is None:
+                # The SDK retries 429/5xx responses with jittered exponential backoff
+                # Keep idle connections longer than the Gemini step (httpx drops them after 5s by default),
+                # so the Claude calls reuse the warmed-up connection instead of a new TLS handshake;
+                # HTTP/2 multiplexes concurrent Claude calls over that connection
+                _CLAUDE_CLIENT = anthropic.AsyncAnthropic(
+                    api_key=CLAUDE_API_KEY,
+                    max_retries=int(os.environ.get("CLAUDE_MAX_RETRIES", "4")),
+                    # Both calls stream, so the read timeout bounds the gap between chunks, not the whole answer
+                    timeout=httpx.Timeout(60.0, connect=10.0),
+                    http_client=anthropic.DefaultAsyncHttpxClient(
+                        http2=True,
+                        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=120)
+                    )
+                )
+                logger.info("Successfully initialized Claude Client")
+        return _CLAUDE_CLIENT
     except Exception as e:
         logger.error(f"Error initializing Claude: {str(e)}")
-        return None 
\ No newline at end of file
+        return None
+
+
+async def warm_up_clients() -> None:
+    """Creates both clients and sends one lightweight request each to open pooled connections"""
+    gemini_client = await asyncio.to_thread(initialize_gemini)
+    if gemini_client:
+        try:
+            await gemini_client.aio.models.list(config={"page_size": 1})
+            logger.info("Gemini connection warmed up")
+        except Exception as e:
+            logger.warning(f"Gemini warm-up request failed: {str(e)}")
+
+    claude_client = initialize_claude()
+    if claude_client:
+        try:
+            await claude_client.with_options(timeout=10).models.list(limit=1)
+            logger.info("Claude connection warmed up")
+        except Exception as e:
+            logger.warning(f"Claude warm-up request failed: {str(e)}")
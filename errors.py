@@ -0,0 +1,9 @@
+import re
+
+# Error strings returned by the Gemini and Claude ratio services always start with one of these
+_ERROR_RE = re.compile(r"Error|An error occurred")
+
+
+def is_error_output(output: str) -> bool:
+    """Checks whether a service output is an error message (anchored match, no full scan)"""
+    return _ERROR_RE.match(output) is not None
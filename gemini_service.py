@@ -1,31 +1,23 @@
+import io
+import os
 import time
+import random
 import asyncio
-import functools
-import json
+import hashlib
+import orjson
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Optional
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from cache import ResponseCache
 from logger import logger
 
+GEMINI_MODEL = "gemini-2.5-flash"
 
-async def query_gemini_with_pdf(client: genai.Client, pdf_content: bytes, company_name: str) -> str:
-    """Query Gemini 2.5 Flash with PDF content for comprehensive financial ratio calculation"""
-    try:
-        start_time = time.time()
-        
-        if not client:
-            logger.error("Gemini client not initialized")
-            return "Error: Gemini client not initialized"
-        
-        model = "gemini-2.5-flash"
-        contents = [
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_bytes(
-                        mime_type="application/pdf",
-                        data=pdf_content
-                    ),
-                    types.Part.from_text(text="""Tu es un agent d'extraction de données financières. Le document fourni contient un bilan, un compte de résultat, et éventuellement des annexes d'une entreprise. 
+# Static extraction instructions, sent as the system instruction ahead of the PDF. At ~900 tokens the
+# prompt alone is below the 1,024-token implicit-caching minimum for gemini-2.5-flash; only a repeat
+# of the same PDF within the cache window can produce a cache hit
+EXTRACTION_PROMPT = """Tu es un agent d'extraction de données financières. Le document fourni contient un bilan, un compte de résultat, et éventuellement des annexes d'une entreprise. 
 
  
 
@@ -193,34 +185,107 @@ Instructions strictes à respecter
 
 •     Ne pas changer ou convertir les unités du document 
 
-•     Si une donnée est absente pour une des deux années, ne pas l'inventer""")
-                ]
-            )
-        ]
+•     Si une donnée est absente pour une des deux années, ne pas l'inventer"""
+
+_GENERATE_CONFIG = types.GenerateContentConfig(
+    system_instruction=EXTRACTION_PROMPT,
+    temperature=0.1,
+    thinking_config=types.ThinkingConfig(
+        thinking_budget=8000,
+    ),
+    response_mime_type="application/json"
+)
+
+# Cap on Gemini calls in flight across concurrent requests, taken per attempt so backoff sleeps hold no slot
+_GEMINI_SEMAPHORE = asyncio.Semaphore(int(os.environ.get("GEMINI_CONCURRENCY", "8")))
+
+# Rate limits and server errors are retried with jittered backoff; other API errors fail immediately
+_RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+_GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", "3"))
+
+
+async def _call_gemini(make_call: Callable[[], Awaitable[Any]]) -> Any:
+    """Awaits make_call() under the Gemini concurrency cap, retrying transient API errors"""
+    for attempt in range(_GEMINI_MAX_RETRIES + 1):
+        if attempt > 0:
+            # Jittered exponential backoff (up to 2, 4, 8 seconds) so concurrent retries spread out
+            wait_time = random.uniform(1, 2 ** attempt)
+            logger.info("Retrying Gemini call in %.1fs (attempt %d/%d)", wait_time, attempt + 1, _GEMINI_MAX_RETRIES + 1)
+            await asyncio.sleep(wait_time)
+
+        try:
+            async with _GEMINI_SEMAPHORE:
+                return await make_call()
+        except errors.APIError as e:
+            if e.code not in _RETRYABLE_STATUS_CODES or attempt == _GEMINI_MAX_RETRIES:
+                raise
+            logger.warning("Gemini error %s on attempt %d: %s", e.code, attempt + 1, e)
+
+
+# Uploaded PDFs keyed by SHA-256; Gemini deletes uploaded files after 48h, so entries expire earlier
+_PDF_FILE_CACHE = ResponseCache(maxsize=256, ttl_seconds=46 * 3600)
+_FILE_EXPIRY_MARGIN = timedelta(minutes=30)
+
+
+async def _get_pdf_part(client: genai.Client, pdf_content: bytes, pdf_sha256: str) -> types.Part:
+    """Returns a File API reference to the PDF, uploading it once per content hash"""
+    uploaded = _PDF_FILE_CACHE.get(pdf_sha256)
+    if uploaded is not None and uploaded.expiration_time is not None:
+        if uploaded.expiration_time <= datetime.now(timezone.utc) + _FILE_EXPIRY_MARGIN:
+            uploaded = None
+
+    if uploaded is None:
+        try:
+            # A fresh stream per attempt, since a failed upload may have consumed the previous one
+            uploaded = await _call_gemini(lambda: client.aio.files.upload(
+                file=io.BytesIO(pdf_content),
+                config=types.UploadFileConfig(mime_type="application/pdf")
+            ))
+            _PDF_FILE_CACHE.set(pdf_sha256, uploaded)
+            logger.info(f"Uploaded PDF to Gemini File API ({len(pdf_content)} bytes)")
+        except Exception as e:
+            # Fall back to sending the bytes inline with the request
+            logger.warning(f"Gemini file upload failed, sending PDF inline: {str(e)}")
+            return types.Part.from_bytes(mime_type="application/pdf", data=pdf_content)
+    else:
+        logger.info("Reusing PDF already uploaded to Gemini File API")
+
+    return types.Part.from_uri(file_uri=uploaded.uri, mime_type="application/pdf")
+
+
+async def query_gemini_with_pdf(client: genai.Client, pdf_content: bytes, company_name: str,
+                                pdf_sha256: Optional[str] = None) -> str:
+    """Query Gemini 2.5 Flash with PDF content for comprehensive financial ratio calculation"""
+    try:
+        start_time = time.time()
         
-        generate_content_config = types.GenerateContentConfig(
-            temperature=0.1,
-            thinking_config=types.ThinkingConfig(
-                thinking_budget=8000,
-            ),
-            response_mime_type="application/json"
-        )
+        if not client:
+            logger.error("Gemini client not initialized")
+            return "Error: Gemini client not initialized"
+        
+        if pdf_sha256 is None:
+            pdf_sha256 = hashlib.sha256(pdf_content).hexdigest()
+        pdf_part = await _get_pdf_part(client, pdf_content, pdf_sha256)
+        
+        # The PDF is the only per-request content; the instructions go in the system prompt
+        contents = [types.Content(role="user", parts=[pdf_part])]
         
         logger.info("Starting Gemini financial data extraction from PDF...")
         
-        loop = asyncio.get_running_loop()
-        generate_func = functools.partial(
-            client.models.generate_content,
-            model=model,
+        # Native async call: no worker thread is held while Gemini generates
+        response = await _call_gemini(lambda: client.aio.models.generate_content(
+            model=GEMINI_MODEL,
             contents=contents,
-            config=generate_content_config
-        )
-        
-        response = await loop.run_in_executor(None, generate_func)
+            config=_GENERATE_CONFIG
+        ))
         
         total_time = time.time() - start_time
         logger.info(f"Gemini completed in {total_time:.2f}s")
         
+        # Informational only: usually 0, since the shared prompt is too short to be cached on its own
+        if response and response.usage_metadata:
+            logger.info(f"Gemini context cache: {response.usage_metadata.cached_content_token_count or 0} tokens read")
+        
         if not response or not response.text:
             logger.error("Gemini returned empty response")
             return "Error: Received an empty response from Gemini."
@@ -228,7 +293,7 @@ Instructions strictes à respecter
         # Validate JSON structure and provide clean logging
         try:
             # Try to parse the JSON to validate it
-            parsed_json = json.loads(response.text)
+            parsed_json = orjson.loads(response.text)
             
             # Additional validation: check if it's a list with expected structure
             if isinstance(parsed_json, list):
@@ -241,14 +306,14 @@ Instructions strictes à respecter
                     logger.info(f"Gemini returned valid JSON list with {len(parsed_json)} entries")
                 else:
                     logger.warning("Gemini JSON entries don't match expected structure")
-                    logger.debug(f"Raw response (first 500 chars): {response.text[:500]}")
+                    logger.debug("Raw response (first 500 chars): %.500s", response.text)
             else:
                 logger.warning("Gemini response is valid JSON but not a list as expected")
-                logger.debug(f"Response type: {type(parsed_json)}")
+                logger.debug("Response type: %s", type(parsed_json))
             
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Gemini returned invalid JSON: {e}")
-            logger.debug(f"Raw Gemini response (first 1000 chars): {response.text[:1000]}")
+            logger.debug("Raw Gemini response (first 1000 chars): %.1000s", response.text)
             
             # Try to extract JSON from the response if it's wrapped in text
             text = response.text.strip()
@@ -260,10 +325,10 @@ Instructions strictes à respecter
             if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
                 try:
                     json_part = text[start_idx:end_idx + 1]
-                    parsed_json = json.loads(json_part)
+                    parsed_json = orjson.loads(json_part)
                     logger.info("Successfully extracted JSON from Gemini response")
-                    return json.dumps(parsed_json, ensure_ascii=False)
-                except json.JSONDecodeError:
+                    return orjson.dumps(parsed_json).decode()
+                except orjson.JSONDecodeError:
                     logger.error("Could not extract valid JSON from Gemini response")
             
             return f"Error: Gemini returned malformed JSON: {str(e)}"
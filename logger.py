@@ -1,5 +1,7 @@
 import logging
 import sys
+import contextvars
+import orjson
 
 # Configure logging
 logger = logging.getLogger("financial-insights")
@@ -9,9 +11,49 @@ logger.setLevel(logging.INFO)
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setLevel(logging.INFO)
 
+# Per-request identifier attached to every log line (set by the API endpoint)
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the current request identifier to log records"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
 # Create formatter
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s')
 console_handler.setFormatter(formatter)
+console_handler.addFilter(RequestIdFilter())
 
 # Add handler to logger
 logger.addHandler(console_handler) 
+
+# Strings longer than this are shortened in logged payloads
+MAX_LOGGED_STRING = 4096
+
+
+def _truncate_for_log(value):
+    """Returns a copy of value with oversized strings shortened for logging"""
+    if isinstance(value, str) and len(value) > MAX_LOGGED_STRING:
+        return f"{value[:MAX_LOGGED_STRING]}... [{len(value) - MAX_LOGGED_STRING} chars truncated]"
+    if isinstance(value, dict):
+        return {key: _truncate_for_log(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_truncate_for_log(item) for item in value]
+    return value
+
+
+class LazyJson:
+    """Log argument that serializes its payload only when the record is emitted"""
+
+    __slots__ = ("payload",)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        return orjson.dumps(_truncate_for_log(self.payload), option=orjson.OPT_INDENT_2).decode()
+
@@ -2,15 +2,21 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import time
-import json
+import uuid
+import asyncio
+import logging
 from dotenv import load_dotenv
-from logger import logger
+
+# Load environment variables before importing modules that read them at import time
+# (API keys, concurrency limits, MAX_PDF_BYTES)
+load_dotenv()
+
+from logger import logger, LazyJson, request_id_var
 
 # Import the core logic function from app.py
 from app import run_analysis 
-
-# Load environment variables
-load_dotenv()
+from pdf_handler import close_session
+from clients import warm_up_clients
 
 # Configure logging
 logger.info("Starting FastAPI Financial Insights Application")
@@ -33,6 +39,16 @@ app.add_middleware(
     allow_headers=["Content-Type", "Accept", "User-Agent", "Authorization"],
 )
 
+# Warm AI provider connections in the background so startup is not delayed
+@app.on_event("startup")
+async def startup_event():
+    app.state.warm_up_task = asyncio.create_task(warm_up_clients())
+
+# Release pooled HTTP connections on shutdown
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_session()
+
 # Input model
 class QueryRequest(BaseModel):
     pdfUrl: str
@@ -45,6 +61,8 @@ class QueryRequest(BaseModel):
 @app.post("/api/insights")
 async def get_financial_insights(request: QueryRequest):
     start_time = time.time()
+    # Tag every log line of this request, including those from worker threads
+    request_id_var.set(uuid.uuid4().hex[:8])
     logger.info(f"Received analysis request for: {request.companyName}")
     
     try:
@@ -63,11 +81,12 @@ async def get_financial_insights(request: QueryRequest):
         if isinstance(analysis_result, dict):
             analysis_result["processing_time"] = processing_time
             
-            # Extensively log the final webhook response
-            formatted_webhook_response = json.dumps(analysis_result, ensure_ascii=False, indent=2)
-            logger.info("=== FINAL WEBHOOK RESPONSE ===")
-            logger.info(f"Complete response with processing time being sent to webhook:\n{formatted_webhook_response}")
-            logger.info("=== END FINAL WEBHOOK RESPONSE ===")
+            # Extensively log the final webhook response (debug only, serialized lazily)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "=== FINAL WEBHOOK RESPONSE ===\nComplete response with processing time being sent to webhook:\n%s\n=== END FINAL WEBHOOK RESPONSE ===",
+                    LazyJson(analysis_result)
+                )
             
             return analysis_result
         else:
@@ -77,11 +96,12 @@ async def get_financial_insights(request: QueryRequest):
                 "processing_time": processing_time
             }
             
-            # Log fallback response
-            formatted_fallback_response = json.dumps(response_data, ensure_ascii=False, indent=2)
-            logger.info("=== FINAL WEBHOOK RESPONSE (FALLBACK) ===")
-            logger.info(f"Fallback response being sent to webhook:\n{formatted_fallback_response}")
-            logger.info("=== END FINAL WEBHOOK RESPONSE ===")
+            # Log fallback response (debug only, serialized lazily)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "=== FINAL WEBHOOK RESPONSE (FALLBACK) ===\nFallback response being sent to webhook:\n%s\n=== END FINAL WEBHOOK RESPONSE ===",
+                    LazyJson(response_data)
+                )
             
             return response_data
     
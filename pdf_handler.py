@@ -1,10 +1,59 @@
+import os
 import time
+import random
 import asyncio
 import aiohttp
+from typing import Optional
 from logger import logger
 
+# Upper bound on a downloaded PDF, so one oversized document cannot exhaust worker memory
+MAX_PDF_BYTES = int(os.environ.get("MAX_PDF_BYTES", str(100 * 1024 * 1024)))
+_DOWNLOAD_CHUNK_SIZE = 1 << 20
 
-async def download_pdf_from_url(pdf_url: str, timeout_seconds: int = 120, max_retries: int = 3) -> bytes:
+# Cap on downloads in flight across concurrent requests
+_DOWNLOAD_SEMAPHORE = asyncio.Semaphore(int(os.environ.get("DOWNLOAD_CONCURRENCY", "32")))
+
+# Shared keep-alive session so repeated downloads reuse pooled connections
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Returns the shared aiohttp session, creating it on first use"""
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=60)
+        )
+    return _SESSION
+
+
+async def close_session() -> None:
+    """Closes the shared aiohttp session (called on application shutdown)"""
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
+
+
+async def _read_pdf_body(response: aiohttp.ClientResponse, max_bytes: int) -> bytearray:
+    """Streams the response body into a buffer that grows as chunks arrive, up to max_bytes"""
+    # Content-Length is the encoded size when the body is compressed, so only trust it for identity bodies
+    expected = None if response.headers.get("Content-Encoding") else response.content_length
+    if expected is not None and expected > max_bytes:
+        raise Exception(f"PDF too large: {expected} bytes (limit {max_bytes})")
+
+    # Grown from what actually arrives rather than sized from the server's claimed length,
+    # and returned as-is since every consumer accepts a bytes-like object
+    buffer = bytearray()
+    async for chunk in response.content.iter_chunked(_DOWNLOAD_CHUNK_SIZE):
+        if len(buffer) + len(chunk) > max_bytes:
+            raise Exception(f"PDF too large: more than {max_bytes} bytes")
+        buffer += chunk
+    return buffer
+
+
+async def download_pdf_from_url(pdf_url: str, timeout_seconds: int = 120, max_retries: int = 3,
+                                session: Optional[aiohttp.ClientSession] = None) -> bytearray:
     """
     Download PDF content from URL with retry logic and configurable timeout
     
@@ -12,61 +61,67 @@ async def download_pdf_from_url(pdf_url: str, timeout_seconds: int = 120, max_re
         pdf_url: URL to download PDF from
         timeout_seconds: Timeout for the download in seconds (default: 120)
         max_retries: Maximum number of retry attempts (default: 3)
+        session: aiohttp session to use (default: the shared keep-alive session)
     
     Returns:
-        bytes: PDF content
+        bytearray: PDF content
         
     Raises:
         Exception: If download fails after all retries
     """
-    logger.info(f"Downloading PDF...")
+    logger.info("Downloading PDF...")
     start_time = time.time()
     
-    # Configure timeout for the session
-    timeout = aiohttp.ClientTimeout(total=timeout_seconds)
+    # Configure timeout for each request on the pooled session
+    # sock_read fails a stalled transfer early instead of waiting for the total timeout
+    timeout = aiohttp.ClientTimeout(total=timeout_seconds, connect=10, sock_read=30)
+    if session is None:
+        session = await get_session()
     
     for attempt in range(max_retries + 1):
         try:
             if attempt > 0:
-                wait_time = 2 ** attempt  # Exponential backoff: 2, 4, 8 seconds
-                logger.info(f"Retrying download in {wait_time}s (attempt {attempt + 1}/{max_retries + 1})")
+                # Jittered exponential backoff (up to 2, 4, 8 seconds) so concurrent retries spread out
+                wait_time = random.uniform(1, 2 ** attempt)
+                logger.info("Retrying download in %.1fs (attempt %d/%d)", wait_time, attempt + 1, max_retries + 1)
                 await asyncio.sleep(wait_time)
             
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(pdf_url) as response:
+            # Hold a download slot only while the request is active, never during the backoff sleep
+            async with _DOWNLOAD_SEMAPHORE:
+                async with session.get(pdf_url, timeout=timeout) as response:
                     if response.status == 200:
-                        content = await response.read()
+                        content = await _read_pdf_body(response, MAX_PDF_BYTES)
                         elapsed = time.time() - start_time
-                        logger.info(f"PDF downloaded successfully in {elapsed:.2f}s ({len(content)} bytes)")
+                        logger.info("PDF downloaded successfully in %.2fs (%d bytes)", elapsed, len(content))
                         return content
                     elif response.status in [502, 503, 504]:  # Server errors that might be temporary
                         error_text = await response.text()
-                        logger.warning(f"Server error {response.status} on attempt {attempt + 1}: {error_text}")
+                        logger.warning("Server error %s on attempt %d: %s", response.status, attempt + 1, error_text)
                         if attempt == max_retries:
                             raise Exception(f"HTTP {response.status}: {error_text}")
                         continue  # Retry for server errors
                     else:
                         # Client errors (4xx) - don't retry
                         error_text = await response.text()
-                        logger.error(f"Client error {response.status}: {error_text}")
+                        logger.error("Client error %s: %s", response.status, error_text)
                         raise Exception(f"HTTP {response.status}: {error_text}")
                         
         except asyncio.TimeoutError:
-            logger.warning(f"Download timeout ({timeout_seconds}s) on attempt {attempt + 1}")
+            logger.warning("Download timeout (%ss) on attempt %d", timeout_seconds, attempt + 1)
             if attempt == max_retries:
-                logger.error(f"PDF download failed after {max_retries + 1} attempts due to timeout")
+                logger.error("PDF download failed after %d attempts due to timeout", max_retries + 1)
                 raise Exception(f"Download timeout after {timeout_seconds} seconds (tried {max_retries + 1} times)")
             continue  # Retry on timeout
             
         except aiohttp.ClientError as e:
-            logger.warning(f"Network error on attempt {attempt + 1}: {str(e)}")
+            logger.warning("Network error on attempt %d: %s", attempt + 1, e)
             if attempt == max_retries:
-                logger.error(f"PDF download failed after {max_retries + 1} attempts due to network error")
+                logger.error("PDF download failed after %d attempts due to network error", max_retries + 1)
                 raise Exception(f"Network error: {str(e)}")
             continue  # Retry on network errors
             
         except Exception as e:
-            logger.error(f"Unexpected error during PDF download: {str(e)}")
+            logger.error("Unexpected error during PDF download: %s", e)
             raise 
     
     # This should never be reached, but just in case